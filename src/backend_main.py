@@ -1,19 +1,43 @@
 # main.py
 import os
 import re
-import json
 import shutil
+import asyncio
+import hashlib
+import sqlite3
 import tempfile
-import subprocess
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 from dotenv import load_dotenv
+import orjson
 
 from starlette.applications import Starlette
 from starlette.routing import Route
-from starlette.responses import JSONResponse, PlainTextResponse, FileResponse
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 
+# optional: only needed for /document/pdf (also requires wkhtmltopdf)
+try:
+    import pdfkit
+except ImportError:
+    pdfkit = None
+
+# optional: runs rules inside this process (embedded V8) instead of going through node
+try:
+    from py_mini_racer import MiniRacer
+except ImportError:
+    MiniRacer = None
+
+# optional: exact multi-pattern placeholder scan (falls back to PH_RE)
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 load_dotenv()
 
 # Basic paths
@@ -25,6 +49,12 @@ CONVERTERS_DIR = BASE_DIR / "converters"
 for d in (UPLOAD_DIR, RULES_DIR, CONVERTERS_DIR):
     d.mkdir(parents=True, exist_ok=True)
 
+# rule files use require()/module.exports; pin RULES_DIR to CommonJS so node doesn't pick up
+# a "type": "module" from an enclosing package.json
+_rules_pkg = RULES_DIR / "package.json"
+if not _rules_pkg.exists():
+    _rules_pkg.write_text('{"type": "commonjs"}\n', encoding="utf-8")
+
 # OpenAI client (openai v1.x)
 from openai import OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -35,17 +65,425 @@ client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
 # utils
 from utils.xml_to_dict import xml_file_to_dict
 from utils.html_tags import extract_placeholders
-from utils.node_runner import run_js_rule
+
+# orjson renders straight to bytes and is considerably faster than the stdlib encoder
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+# System prompt for /rules/generate. Kept identical across requests (the tag goes in the
+# user message) so it forms a cacheable prompt prefix.
+RULE_SYSTEM_PROMPT = (
+    "You are a JavaScript code generator. Generate a single JavaScript function with the "
+    "function name given in the request that accepts one argument 'data' (an object) and returns a string value "
+    "for the template placeholder. Use only JavaScript. Do NOT include ANY markdown or explanation. "
+    "Function should be robust (handle missing properties) and return a string. Example: "
+    "function generate_X(data) { try { return data.X || ''; } catch(e) { return ''; } }"
+)
+
+def _cached_prompt_tokens(response) -> int:
+    # number of prompt tokens served from the provider's prompt cache (0 if not reported)
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+# Application-level cache of generated rule code, keyed by (tag, normalized prompt).
+# A hit skips the OpenAI round-trip entirely.
+RULE_CACHE_DB = BASE_DIR / "rule_cache.sqlite3"
+
+# one connection shared by whichever thread runs the handler (event loop, TestClient portal, ...);
+# the lock serializes access since a sqlite3 connection isn't safe for concurrent use
+_rule_cache_db = sqlite3.connect(RULE_CACHE_DB, check_same_thread=False)
+_rule_cache_lock = threading.Lock()
+_rule_cache_db.execute(
+    "CREATE TABLE IF NOT EXISTS rule_cache ("
+    "key TEXT PRIMARY KEY, tag TEXT NOT NULL, prompt TEXT NOT NULL, code TEXT NOT NULL)"
+)
+_rule_cache_db.commit()
+
+def rule_cache_key(tag: str, prompt: str, sample_json: str) -> str:
+    # whitespace-insensitive; case is kept since prompts may quote literal values.
+    # The xml sample shown to the model is part of the key, so a new upload with
+    # different field names doesn't reuse code written against the old ones.
+    normalized = " ".join(prompt.split())
+    return hashlib.sha256(f"{tag}\x00{normalized}\x00{sample_json}".encode("utf-8")).hexdigest()
+
+def rule_cache_get(key: str):
+    with _rule_cache_lock:
+        row = _rule_cache_db.execute("SELECT code FROM rule_cache WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def rule_cache_put(key: str, tag: str, prompt: str, code: str):
+    with _rule_cache_lock, _rule_cache_db:
+        _rule_cache_db.execute(
+            "INSERT OR REPLACE INTO rule_cache (key, tag, prompt, code) VALUES (?, ?, ?, ?)",
+            (key, tag, prompt, code),
+        )
 
 # Simple helpers
+_SAFE_TAG_RE = re.compile(r'[^0-9A-Za-z_]')
+
+@lru_cache(maxsize=512)
 def safe_tag_name(tag: str) -> str:
     # keep letters, numbers and underscore
-    return re.sub(r'[^0-9A-Za-z_]', '_', tag)
+    return _SAFE_TAG_RE.sub('_', tag)
+
+@lru_cache(maxsize=256)
+def _cached_is_batchable(path_str: str, mtime_ns: int) -> bool:
+    return "require.main === module" in Path(path_str).read_text(encoding="utf-8")
+
+def is_batchable_rule(rule_file: Path) -> bool:
+    # rule files saved before the require() export existed can only run via stdin
+    st = rule_file.stat()
+    return _cached_is_batchable(str(rule_file), st.st_mtime_ns)
+
+async def _run_node(args: list, stdin_bytes: bytes, timeout: float) -> bytes:
+    proc = await asyncio.create_subprocess_exec(
+        "node", *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(stdin_bytes), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise RuntimeError(f"node timed out after {timeout}s")
+    if proc.returncode != 0:
+        raise RuntimeError(stderr.decode("utf-8", "replace").strip() or f"node exited with code {proc.returncode}")
+    return stdout
+
+async def run_js_rule_async(rule_file: Path, data_json: bytes, timeout: int = 10) -> str:
+    # data_json is the already serialized data object, so callers can share one encoding
+    stdout = await _run_node([str(rule_file)], data_json, timeout)
+    return stdout.decode("utf-8").strip()
+
+# One long-lived node process (rule_server.cjs) runs exportable rules, so node startup and
+# each rule's require() are paid once rather than per call.
+class NodeWorker:
+    def __init__(self, script: Path):
+        self.script = script
+        self._proc = None
+        self._pending = {}
+        self._next_id = 0
+        self._reader = None
+        self._start_lock = asyncio.Lock()
+
+    async def _ensure_started(self):
+        async with self._start_lock:
+            if self._proc is not None and self._proc.returncode is None:
+                return
+            self._proc = await asyncio.create_subprocess_exec(
+                "node", str(self.script),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                limit=1 << 24,  # a response is one line holding every rendered value
+            )
+            self._pending = {}
+            # keep a reference so the reader task isn't garbage-collected while it runs
+            self._reader = asyncio.create_task(self._read_responses(self._proc, self._pending))
+
+    async def _read_responses(self, proc, pending: dict):
+        try:
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                msg = orjson.loads(line)
+                fut = pending.pop(msg.get("id"), None)
+                if fut is not None and not fut.done():
+                    fut.set_result(msg)
+        except Exception as e:
+            print(f"Warning: node rule worker reader failed: {e}")
+        finally:
+            # the worker exited, was killed, or sent something unreadable (e.g. a line over the
+            # limit): make sure it is gone and fail whatever was still waiting on it
+            if self._proc is proc:
+                self._proc = None
+            if proc.returncode is None:
+                proc.kill()
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(RuntimeError("node rule worker exited"))
+            pending.clear()
+
+    async def call(self, rule_files: dict, data_json: bytes, timeout: float) -> dict:
+        # rule_files maps tag -> rule file; returns {"results": {tag: value}, "errors": {tag: message}}.
+        # timeout is per rule and enforced inside the worker, so a runaway rule only fails itself.
+        await self._ensure_started()
+        proc, pending = self._proc, self._pending
+        self._next_id += 1
+        req_id = self._next_id
+        fut = asyncio.get_running_loop().create_future()
+        pending[req_id] = fut
+
+        rules_json = orjson.dumps({tag: str(f) for tag, f in rule_files.items()})
+        proc.stdin.write(
+            b'{"id":%d,"timeout_ms":%d,"rules":' % (req_id, int(timeout * 1000))
+            + rules_json + b',"data":' + data_json + b'}\n'
+        )
+        try:
+            await proc.stdin.drain()
+            # rules run one after another, plus a grace period for the worker itself
+            return await asyncio.wait_for(fut, timeout * max(len(rule_files), 1) + 5)
+        except asyncio.TimeoutError:
+            # the worker itself is stuck (its own rule timeouts didn't fire); last resort:
+            # kill it and start fresh on the next call. Other in-flight calls fail and fall back.
+            if self._proc is proc:
+                self._proc = None
+            if proc.returncode is None:
+                proc.kill()
+            raise RuntimeError(f"node rule worker timed out after {timeout}s")
+        finally:
+            pending.pop(req_id, None)
+
+    async def close(self):
+        proc = self._proc
+        if proc is not None and proc.returncode is None:
+            proc.stdin.close()
+            try:
+                await asyncio.wait_for(proc.wait(), 5)
+            except asyncio.TimeoutError:
+                proc.kill()
+
+rule_worker = NodeWorker(BASE_DIR / "rule_server.cjs")
+
+# Shims so a rule file's CommonJS wrapper evaluates in a bare V8 context. Anything node-only
+# (require()d modules, process, Buffer, timers, atob/URL/TextEncoder & co.) is a proxy that
+# flags the call as needing node, even if the rule swallows the exception in its own try/catch.
+MINI_RACER_PRELUDE = """
+var global = globalThis;
+var module = { exports: {} };
+var exports = module.exports;
+var __needsNode = false;
+function __nodeOnly() {
+  const fail = () => { __needsNode = true; throw new Error('needs node'); };
+  return new Proxy(function () {}, { get: fail, apply: fail, construct: fail });
+}
+function require(name) { return __nodeOnly(); }
+// node/web globals a bare V8 isolate doesn't have
+var process = __nodeOnly(), Buffer = __nodeOnly(), __dirname = __nodeOnly(), __filename = __nodeOnly(),
+    setTimeout = __nodeOnly(), setInterval = __nodeOnly(), setImmediate = __nodeOnly(),
+    clearTimeout = __nodeOnly(), clearInterval = __nodeOnly(), clearImmediate = __nodeOnly(),
+    queueMicrotask = __nodeOnly(), structuredClone = __nodeOnly(), atob = __nodeOnly(), btoa = __nodeOnly(),
+    URL = __nodeOnly(), URLSearchParams = __nodeOnly(), TextEncoder = __nodeOnly(), TextDecoder = __nodeOnly(),
+    fetch = __nodeOnly(), performance = __nodeOnly();
+var console = { log() {}, info() {}, warn() {}, error() {}, debug() {} };
+"""
+
+MINI_RACER_RUNNER = """
+function __runRule(data) {
+  __needsNode = false;
+  const fn = module.exports;
+  if (typeof fn !== 'function') return JSON.stringify({ needsNode: true });
+  let out;
+  try {
+    out = fn(data);
+  } catch (e) {
+    // a ReferenceError is most likely some other global node provides and V8 alone doesn't
+    if (__needsNode || e instanceof ReferenceError) return JSON.stringify({ needsNode: true });
+    return JSON.stringify({ error: e && e.message ? e.message : String(e) });
+  }
+  if (__needsNode || (out && typeof out.then === 'function')) return JSON.stringify({ needsNode: true });
+  const value = typeof out === 'object' ? JSON.stringify(out) : String(out === undefined || out === null ? '' : out);
+  return JSON.stringify({ value });
+}
+"""
+
+# rule file path -> (mtime_ns, MiniRacer context or None if the file only works under node, lock).
+# One isolate per rule, rebuilt when the file changes; least recently used ones are dropped.
+RULE_CTX_MAX = 32
+_rule_ctx = OrderedDict()
+_rule_ctx_lock = threading.Lock()
+
+def _rule_context(rule_file: Path):
+    key = str(rule_file)
+    mtime_ns = rule_file.stat().st_mtime_ns
+    with _rule_ctx_lock:
+        cached = _rule_ctx.get(key)
+        if cached and cached[0] == mtime_ns:
+            _rule_ctx.move_to_end(key)
+            return cached[1], cached[2]
+    ctx = MiniRacer()
+    try:
+        ctx.eval(MINI_RACER_PRELUDE)
+        ctx.eval(rule_file.read_text(encoding="utf-8"))
+        ctx.eval(MINI_RACER_RUNNER)
+    except Exception:
+        # top-level code that V8 alone can't run; node will load it (or report the real error)
+        ctx = None
+    entry = (mtime_ns, ctx, threading.Lock())
+    with _rule_ctx_lock:
+        _rule_ctx[key] = entry
+        _rule_ctx.move_to_end(key)
+        while len(_rule_ctx) > RULE_CTX_MAX:
+            _rule_ctx.popitem(last=False)
+    return entry[1], entry[2]
+
+def _run_rule_in_process_sync(rule_file: Path, data_json: bytes, timeout: int):
+    ctx, lock = _rule_context(rule_file)
+    if ctx is None:
+        return None
+    # a context must not be entered from two threads at once
+    with lock:
+        try:
+            # data_json is a valid JS expression, so the shared encoding is reused as-is
+            raw = ctx.eval("__runRule(" + data_json.decode("utf-8") + ")", timeout=timeout * 1000)
+        except Exception as e:
+            # timeouts and engine errors are the rule's fault; running it again under node won't help
+            raise RuntimeError(f"ERROR_RUNNING_RULE: {e}")
+    out = orjson.loads(raw)
+    if out.get("needsNode"):
+        return None
+    if "error" in out:
+        raise RuntimeError(f"ERROR_RUNNING_RULE: {out['error']}")
+    return out["value"]
+
+async def run_rule_in_process(rule_file: Path, data_json: bytes, timeout: int = 10):
+    # returns None when the rule needs node (or MiniRacer isn't installed); raises if the rule
+    # itself fails. Runs in a worker thread so a slow rule doesn't block the event loop.
+    if MiniRacer is None:
+        return None
+    return await asyncio.to_thread(_run_rule_in_process_sync, rule_file, data_json, timeout)
+
+async def run_js_rules_batch(rule_files: dict, data_json: bytes, timeout: int = 10) -> dict:
+    # returns tag -> value for every rule that succeeded
+    tags = list(rule_files)
+    outcomes = await asyncio.gather(
+        *(run_rule_in_process(rule_files[tag], data_json, timeout) for tag in tags),
+        return_exceptions=True,
+    )
+    values = {}
+    remaining = {}
+    for tag, outcome in zip(tags, outcomes):
+        if outcome is None:
+            remaining[tag] = rule_files[tag]
+        elif not isinstance(outcome, Exception):
+            values[tag] = outcome
+    if remaining:
+        msg = await rule_worker.call(remaining, data_json, timeout)
+        values.update(msg["results"])
+    return values
+
+# Placeholders in templates look like /*TagName*/
+PH_RE = re.compile(r'/\*([^*/]+)\*/')
+
+def iter_segments(html: str, resolved: dict, automaton=None):
+    # yields the html split into literal spans and resolved values, in order
+    if automaton is not None:
+        # only the known /*tag*/ strings match; iter_long gives leftmost-longest, non-overlapping hits
+        hits = ((end + 1 - length, end + 1, tag) for end, (tag, length) in automaton.iter_long(html))
+    else:
+        hits = ((m.start(), m.end(), m.group(1)) for m in PH_RE.finditer(html))
+    last = 0
+    for start, end, tag in hits:
+        if tag not in resolved:
+            # comments that aren't known placeholders are left untouched
+            continue
+        yield html[last:start]
+        yield resolved[tag]
+        last = end
+    yield html[last:]
+
+def stream_rendered_json(segments, chunk: int = 1 << 16):
+    # encodes {"success": true, "html": <filled html>} piece by piece into a bytearray and flushes
+    # it every `chunk` bytes, so the filled document is never materialized as one string
+    buf = bytearray(b'{"success":true,"html":"')
+    for segment in segments:
+        if segment:
+            # orjson's encoding of a str is the escaped body between the two quotes
+            buf += orjson.dumps(segment if isinstance(segment, str) else str(segment))[1:-1]
+        if len(buf) >= chunk:
+            yield bytes(buf)
+            buf.clear()
+    buf += b'"}'
+    yield bytes(buf)
+
+# Parsed uploads are memoized on (path, mtime, size) so a re-upload invalidates them
+@lru_cache(maxsize=8)
+def _cached_xml(path_str: str, mtime_ns: int, size: int) -> dict:
+    return xml_file_to_dict(Path(path_str))
+
+@lru_cache(maxsize=8)
+def _cached_html(path_str: str, mtime_ns: int, size: int) -> tuple:
+    html = Path(path_str).read_text(encoding="utf-8")
+    return html, extract_placeholders(html)
+
+@lru_cache(maxsize=8)
+def _cached_automaton(path_str: str, mtime_ns: int, size: int):
+    _, placeholders = _cached_html(path_str, mtime_ns, size)
+    if not placeholders:
+        return None
+    automaton = ahocorasick.Automaton()
+    for tag in placeholders:
+        pattern = f"/*{tag}*/"
+        automaton.add_word(pattern, (tag, len(pattern)))
+    automaton.make_automaton()
+    return automaton
+
+def load_xml(xml_path: Path) -> dict:
+    st = xml_path.stat()
+    return _cached_xml(str(xml_path), st.st_mtime_ns, st.st_size)
+
+def load_html(html_path: Path) -> tuple:
+    # returns (html, placeholders)
+    st = html_path.stat()
+    return _cached_html(str(html_path), st.st_mtime_ns, st.st_size)
+
+def load_automaton(html_path: Path):
+    # Aho-Corasick automaton over the uploaded template's placeholders, or None without pyahocorasick
+    if ahocorasick is None:
+        return None
+    st = html_path.stat()
+    return _cached_automaton(str(html_path), st.st_mtime_ns, st.st_size)
+
+# process umask, read once (os.umask can only be queried by setting it)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Copy an UploadFile to disk in fixed-size chunks so large uploads aren't held in memory.
+# It is written to a temp file next to dst_path and renamed over it, so readers (and other
+# worker processes) never see a half-written file.
+async def _stream_to(upload, dst_path: Path, chunk: int = 1 << 16):
+    fd, tmp_name = tempfile.mkstemp(dir=dst_path.parent, prefix=f".{dst_path.name}.", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            # mkstemp creates 0600; give the file the mode a plain open() would have
+            os.fchmod(f.fileno(), 0o666 & ~_UMASK)
+            while True:
+                data = await upload.read(chunk)
+                if not data:
+                    break
+                f.write(data)
+        os.replace(tmp_name, dst_path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+# Same temp-file + os.replace approach for files written in one go (rule files): other worker
+# processes may require()/eval them at any moment and must never see a partial file.
+def _write_text_atomic(dst_path: Path, text: str):
+    fd, tmp_name = tempfile.mkstemp(dir=dst_path.parent, prefix=f".{dst_path.name}.", suffix=".part")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            os.fchmod(f.fileno(), 0o666 & ~_UMASK)
+            f.write(text)
+        os.replace(tmp_name, dst_path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
 
 # ROUTES
 
 async def root(request):
-    return JSONResponse({"message": "Template Rules Backend running"})
+    return ORJSONResponse({"message": "Template Rules Backend running"})
+
+async def health(request):
+    return ORJSONResponse({
+        "status": "healthy",
+        "openai_configured": OPENAI_API_KEY is not None
+    })
 
 # Upload endpoint - accepts multipart form with two files: html and thml(xml)
 async def upload_files(request):
@@ -54,19 +492,16 @@ async def upload_files(request):
     xml_file = form.get("xml")
 
     if not html_file or not xml_file:
-        return JSONResponse({"success": False, "error": "Both html and xml files required (fields: html, xml)."}, status_code=400)
+        return ORJSONResponse({"success": False, "error": "Both html and xml files required (fields: html, xml)."}, status_code=400)
 
     # Save files
     html_path = UPLOAD_DIR / "sample.html"
     xml_path = UPLOAD_DIR / "sample-thml.xml"
 
-    with open(html_path, "wb") as f:
-        f.write(await html_file.read())
+    await _stream_to(html_file, html_path)
+    await _stream_to(xml_file, xml_path)
 
-    with open(xml_path, "wb") as f:
-        f.write(await xml_file.read())
-
-    return JSONResponse({"success": True, "html_path": str(html_path), "xml_path": str(xml_path)})
+    return ORJSONResponse({"success": True, "html_path": str(html_path), "xml_path": str(xml_path)})
 
 # Return list of placeholders and classification (static/dynamic)
 async def get_tags(request):
@@ -74,12 +509,11 @@ async def get_tags(request):
     xml_path = UPLOAD_DIR / "sample-thml.xml"
 
     if not html_path.exists() or not xml_path.exists():
-        return JSONResponse({"success": False, "error": "Uploaded files not found. Use /upload first."}, status_code=400)
+        return ORJSONResponse({"success": False, "error": "Uploaded files not found. Use /upload first."}, status_code=400)
 
-    html = html_path.read_text(encoding="utf-8")
-    placeholders = extract_placeholders(html)  # list like ['CandidateName', 'OfferSummary', ...]
+    html, placeholders = load_html(html_path)  # placeholders like ['CandidateName', 'OfferSummary', ...]
 
-    xml_data = xml_file_to_dict(xml_path)
+    xml_data = load_xml(xml_path)
     result = []
     for tag in placeholders:
         result.append({
@@ -89,68 +523,78 @@ async def get_tags(request):
             "rule_exists": (RULES_DIR / f"rule_{safe_tag_name(tag)}.js").exists()
         })
 
-    return JSONResponse({"success": True, "placeholders": result})
+    return ORJSONResponse({"success": True, "placeholders": result})
+
+# Ask OpenAI for the rule function; returns (generated_code, cached_prompt_tokens)
+def _generate_rule_code(tag: str, prompt: str, sample_json: str) -> tuple:
+    # Static content goes first (system prompt, then the xml sample) and the per-request
+    # tag/prompt last, so the provider's automatic prompt caching can reuse the prefix
+    user_prompt = (
+        "XML sample data (JSON):\n"
+        f"{sample_json}\n\n"
+        f"Tag: {tag}\n"
+        f"Function name: generate_{tag}\n"
+        f"Prompt: {prompt}\n\n"
+        "Generate the JS function now."
+    )
+
+    response = client.chat.completions.create(
+        model="gpt-4",
+        messages=[
+            {"role": "system", "content": RULE_SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.0,
+        max_tokens=800
+    )
+    cached_tokens = _cached_prompt_tokens(response)
+    generated_code = response.choices[0].message.content.strip()
+
+    # Clean code fences if present
+    if generated_code.startswith("```"):
+        parts = generated_code.split("```")
+        if len(parts) >= 2:
+            generated_code = parts[1].strip()
+            # drop language if present
+            if generated_code.startswith("javascript") or generated_code.startswith("js"):
+                generated_code = "\n".join(generated_code.split("\n")[1:])
+    return generated_code, cached_tokens
 
 # Generate rule: call OpenAI with prompt + xml sample and save returned JS function as rule file
 async def generate_rule(request):
-    if client is None:
-        return JSONResponse({"success": False, "error": "OpenAI key not configured on server."}, status_code=500)
-
     body = await request.json()
     tag = body.get("tag")              # e.g., "OfferSummary"
     prompt = body.get("prompt")        # user prompt describing how to compute the tag
     example_limit = int(body.get("example_limit", 10))
+    # false forces a fresh generation; accept JSON booleans as well as "false"/"0" strings
+    use_cache = str(body.get("use_cache", True)).strip().lower() not in ("false", "0", "no", "off")
 
     if not tag or not prompt:
-        return JSONResponse({"success": False, "error": "tag and prompt are required"}, status_code=400)
+        return ORJSONResponse({"success": False, "error": "tag and prompt are required"}, status_code=400)
 
     html_path = UPLOAD_DIR / "sample.html"
     xml_path = UPLOAD_DIR / "sample-thml.xml"
 
     if not xml_path.exists():
-        return JSONResponse({"success": False, "error": "XML file not uploaded"}, status_code=400)
+        return ORJSONResponse({"success": False, "error": "XML file not uploaded"}, status_code=400)
 
     # Prepare context: sample xml data (small subset)
-    xml_data = xml_file_to_dict(xml_path)
-    sample_data = {k: xml_data[k] for i,k in enumerate(xml_data) if i < example_limit}
-
-    # Build system + user prompts
-    system_prompt = (
-        "You are a JavaScript code generator. Generate a single JavaScript function named "
-        f"'generate_{tag}' that accepts one argument 'data' (an object) and returns a string value "
-        "for the template placeholder. Use only JavaScript. Do NOT include ANY markdown or explanation. "
-        "Function should be robust (handle missing properties) and return a string. Example: "
-        "function generate_X(data) { try { return data.X || ''; } catch(e) { return ''; } }"
-    )
+    xml_data = load_xml(xml_path)
+    sample_data = dict(islice(xml_data.items(), example_limit))
+    sample_json = orjson.dumps(sample_data, option=orjson.OPT_INDENT_2).decode("utf-8")
 
-    user_prompt = (
-        f"Tag: {tag}\n"
-        f"Prompt: {prompt}\n\n"
-        "XML sample data (JSON):\n"
-        f"{json.dumps(sample_data, indent=2)}\n\n"
-        "Generate the JS function now."
-    )
+    cache_key = rule_cache_key(tag, prompt, sample_json)
+    cached_tokens = 0
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.0,
-            max_tokens=800
-        )
-        generated_code = response.choices[0].message.content.strip()
-
-        # Clean code fences if present
-        if generated_code.startswith("```"):
-            parts = generated_code.split("```")
-            if len(parts) >= 2:
-                generated_code = parts[1].strip()
-                # drop language if present
-                if generated_code.startswith("javascript") or generated_code.startswith("js"):
-                    generated_code = "\n".join(generated_code.split("\n")[1:])
+        generated_code = rule_cache_get(cache_key) if use_cache else None
+        from_cache = generated_code is not None
+        if not from_cache:
+            # a cache hit never talks to OpenAI, so the key is only required on a miss
+            if client is None:
+                return ORJSONResponse({"success": False, "error": "OpenAI key not configured on server."}, status_code=500)
+            generated_code, cached_tokens = _generate_rule_code(tag, prompt, sample_json)
+            rule_cache_put(cache_key, tag, prompt, generated_code)
 
         # Save as executable Node script wrapper:
         safe = safe_tag_name(tag)
@@ -162,6 +606,29 @@ async def generate_rule(request):
 // Saved at: {rule_filename.name}
 {generated_code}
 
+// Resolve the rule function (shared by the stdin runner and require())
+function resolveRule() {{
+  // Try multiple candidate function names
+  const fnNames = ['generate_{tag}', 'generate{tag}', 'generate_{safe}', 'generate{safe}'];
+  let fn = null;
+  for (const n of fnNames) {{
+    if (typeof global[n] === 'function') fn = global[n];
+    try {{ if (typeof eval(n) === 'function') fn = eval(n); }} catch (e) {{}}
+    if (fn) break;
+  }}
+  // as fallback try function named generate_TagName
+  if (!fn && typeof generate === 'function') fn = generate;
+  if (!fn) {{
+    // try to find any function defined in file and use it
+    const keys = Object.getOwnPropertyNames(global).filter(k => typeof global[k] === 'function');
+    if (keys.length) {{
+      fn = global[keys[keys.length-1]];
+    }}
+  }}
+  return fn;
+}}
+module.exports = resolveRule();
+
 // Runner: read JSON from stdin, call the function and print result
 const fs = require('fs');
 async function run() {{
@@ -170,23 +637,7 @@ async function run() {{
     process.stdin.setEncoding('utf8');
     for await (const chunk of process.stdin) input += chunk;
     const data = JSON.parse(input || '{{}}');
-    // Try multiple candidate function names
-    const fnNames = ['generate_{tag}', 'generate{tag}', 'generate_{safe}', 'generate{safe}'];
-    let fn = null;
-    for (const n of fnNames) {{
-      if (typeof global[n] === 'function') fn = global[n];
-      if (typeof eval(n) === 'function') fn = eval(n);
-      if (fn) break;
-    }}
-    // as fallback try function named generate_TagName
-    if (!fn && typeof generate === 'function') fn = generate;
-    if (!fn) {{
-      // try to find any function defined in file and use it
-      const keys = Object.getOwnPropertyNames(global).filter(k => typeof global[k] === 'function');
-      if (keys.length) {{
-        fn = global[keys[keys.length-1]];
-      }}
-    }}
+    const fn = module.exports;
     if (!fn) {{
       console.error("No function found in rule file for tag {tag}");
       process.exit(2);
@@ -202,101 +653,226 @@ async function run() {{
     process.exit(3);
   }}
 }}
-run();
+if (require.main === module) run();
 """
-        rule_filename.write_text(wrapper, encoding="utf-8")
-        return JSONResponse({"success": True, "rule_file": str(rule_filename), "generated_code": generated_code})
+        _write_text_atomic(rule_filename, wrapper)
+        return ORJSONResponse({"success": True, "rule_file": str(rule_filename), "generated_code": generated_code, "cached_tokens": cached_tokens, "from_cache": from_cache})
 
     except Exception as e:
-        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+        return ORJSONResponse({"success": False, "error": str(e)}, status_code=500)
 
 # Test rule: run saved JS with current XML data and return computed value
 async def test_rule(request):
     body = await request.json()
     tag = body.get("tag")
     if not tag:
-        return JSONResponse({"success": False, "error": "tag required"}, status_code=400)
+        return ORJSONResponse({"success": False, "error": "tag required"}, status_code=400)
     safe = safe_tag_name(tag)
     rule_file = RULES_DIR / f"rule_{safe}.js"
     xml_path = UPLOAD_DIR / "sample-thml.xml"
     if not rule_file.exists():
-        return JSONResponse({"success": False, "error": f"Rule file not found: {rule_file.name}"}, status_code=404)
+        return ORJSONResponse({"success": False, "error": f"Rule file not found: {rule_file.name}"}, status_code=404)
     if not xml_path.exists():
-        return JSONResponse({"success": False, "error": "XML file not uploaded"}, status_code=400)
+        return ORJSONResponse({"success": False, "error": "XML file not uploaded"}, status_code=400)
 
-    data = xml_file_to_dict(xml_path)
+    data = load_xml(xml_path)
     try:
-        out = run_js_rule(rule_file, data, timeout=10)
-        return JSONResponse({"success": True, "value": out})
+        data_json = orjson.dumps(data)
+        out = None
+        if is_batchable_rule(rule_file):
+            out = await run_rule_in_process(rule_file, data_json, timeout=10)
+            if out is None:
+                try:
+                    msg = await rule_worker.call({tag: rule_file}, data_json, timeout=10)
+                except Exception:
+                    # the shared worker died or hung; run this rule in its own process instead
+                    msg = None
+                if msg is None:
+                    out = await run_js_rule_async(rule_file, data_json, timeout=10)
+                elif tag in msg["errors"]:
+                    raise RuntimeError(f"ERROR_RUNNING_RULE: {msg['errors'][tag]}")
+                else:
+                    out = msg["results"][tag]
+        else:
+            out = await run_js_rule_async(rule_file, data_json, timeout=10)
+        return ORJSONResponse({"success": True, "value": out})
     except Exception as e:
-        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+        return ORJSONResponse({"success": False, "error": str(e)}, status_code=500)
 
 # Render document: fill static tags and run dynamic rules (for all dynamic placeholders)
 async def render_document(request):
     html_path = UPLOAD_DIR / "sample.html"
     xml_path = UPLOAD_DIR / "sample-thml.xml"
     if not html_path.exists() or not xml_path.exists():
-        return JSONResponse({"success": False, "error": "Uploaded files not found. Use /upload first."}, status_code=400)
-
-    html = html_path.read_text(encoding="utf-8")
-    xml_data = xml_file_to_dict(xml_path)
-    placeholders = extract_placeholders(html)
-
-    filled = html
-    for tag in placeholders:
-        placeholder = f"/*{tag}*/"
+        return ORJSONResponse({"success": False, "error": "Uploaded files not found. Use /upload first."}, status_code=400)
+
+    html, placeholders = load_html(html_path)
+    xml_data = load_xml(xml_path)
+
+    # resolve every tag first, then substitute them all in a single pass over the html
+    resolved = {}
+    batch = {}
+    legacy = {}
+    # a tag may appear several times in the html; resolve it once, the substitution fills every occurrence
+    unique_tags = list(dict.fromkeys(placeholders))
+    for tag in unique_tags:
         if tag in xml_data:
-            filled = filled.replace(placeholder, xml_data[tag])
+            resolved[tag] = xml_data[tag]
         else:
             # dynamic rule expected
             safe = safe_tag_name(tag)
             rule_file = RULES_DIR / f"rule_{safe}.js"
             if not rule_file.exists():
-                filled = filled.replace(placeholder, f"[MISSING_RULE:{tag}]")
-                continue
-            try:
-                value = run_js_rule(rule_file, xml_data, timeout=10)
-                filled = filled.replace(placeholder, value)
-            except Exception as e:
-                filled = filled.replace(placeholder, f"[RULE_ERROR:{tag}]")
+                resolved[tag] = f"[MISSING_RULE:{tag}]"
+            elif is_batchable_rule(rule_file):
+                batch[tag] = rule_file
+            else:
+                legacy[tag] = rule_file
+
+    # exportable rules go to the persistent node worker in one request, concurrently with any legacy rule files
+    data_json = orjson.dumps(xml_data)
+    batch_task = run_js_rules_batch(batch, data_json, timeout=10)
+    legacy_tags = list(legacy)
+    results = await asyncio.gather(
+        batch_task,
+        *(run_js_rule_async(legacy[tag], data_json, timeout=10) for tag in legacy_tags),
+        return_exceptions=True,
+    )
+    values, legacy_results = results[0], results[1:]
+
+    if isinstance(values, Exception):
+        # e.g. a rule called process.exit - retry them one process each
+        batch_tags = list(batch)
+        values = dict(zip(batch_tags, await asyncio.gather(
+            *(run_js_rule_async(batch[tag], data_json, timeout=10) for tag in batch_tags),
+            return_exceptions=True,
+        )))
+    values.update(zip(legacy_tags, legacy_results))
+
+    for tag in (*batch, *legacy):
+        value = values.get(tag)
+        if value is None or isinstance(value, Exception):
+            resolved[tag] = f"[RULE_ERROR:{tag}]"
+        else:
+            resolved[tag] = value
 
-    return JSONResponse({"success": True, "html": filled})
+    segments = iter_segments(html, resolved, load_automaton(html_path))
+    return StreamingResponse(stream_rendered_json(segments), media_type="application/json")
 
 # Convert document to PDF (requires wkhtmltopdf + pdfkit)
 async def document_to_pdf(request):
     body = await request.json()
     html_content = body.get("html")
     if not html_content:
-        return JSONResponse({"success": False, "error": "html required in body"}, status_code=400)
+        return ORJSONResponse({"success": False, "error": "html required in body"}, status_code=400)
+    if pdfkit is None:
+        return ORJSONResponse({"success": False, "error": "PDF conversion unavailable: pdfkit is not installed"}, status_code=501)
+
+    try:
+        # wkhtmltopdf runs in a worker thread so the event loop keeps serving other requests;
+        # output_path=False makes pdfkit return the PDF bytes instead of writing a file
+        pdf_bytes = await asyncio.to_thread(pdfkit.from_string, html_content, False)
+        return Response(
+            pdf_bytes,
+            media_type="application/pdf",
+            headers={"Content-Disposition": 'attachment; filename="document.pdf"'},
+        )
+    except Exception as e:
+        return ORJSONResponse({"success": False, "error": f"PDF conversion failed: {str(e)}"}, status_code=500)
+
+# Frontend editor endpoints (/api/rules/*): generate code from a prompt without saving a rule file,
+# and a structural check of code the frontend executes itself
+async def api_generate_rule(request):
+    try:
+        body = await request.json()
+        prompt = body.get("prompt")
+        field_name = body.get("field_name")
+
+        if not prompt or not field_name:
+            return ORJSONResponse({"success": False, "error": "prompt and field_name required"}, status_code=400)
+        if client is None:
+            return ORJSONResponse({"success": False, "error": "OpenAI key not configured on server."}, status_code=500)
+
+        system_prompt = """You are a JavaScript code generator for a template filling system.
+Generate ONLY the JavaScript function. No explanations, no markdown.
+Function name MUST be generate_{field_name}.
+Use fetchFromTHML(tagName) to get values.
+Handle errors gracefully.
+"""
+
+        user_prompt = f"Field name: {field_name}\nPrompt: {prompt}\nGenerate function now."
+
+        resp = client.chat.completions.create(
+            model="gpt-4",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.3
+        )
+
+        generated_code = resp.choices[0].message.content.strip()
 
+        # cleanup markdown if exists
+        if generated_code.startswith("```"):
+            generated_code = generated_code.strip("`").split("\n", 1)[-1]
+
+        return ORJSONResponse({
+            "success": True,
+            "field_name": field_name,
+            "generated_code": generated_code
+        })
+
+    except Exception as e:
+        return ORJSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+async def api_test_rule(request):
     try:
-        # Use a temp file
-        tmp_html = tempfile.NamedTemporaryFile(delete=False, suffix=".html", mode="w", encoding="utf-8")
-        tmp_html.write(html_content)
-        tmp_html.close()
-        pdf_path = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf").name
-
-        # import here to keep requirements optional
-        import pdfkit
-        pdfkit.from_file(tmp_html.name, pdf_path)
-        # return file response
-        return FileResponse(pdf_path, media_type="application/pdf", filename="document.pdf")
+        body = await request.json()
+        code = body.get("code")
+        field_name = body.get("field_name")
+
+        if not code:
+            return ORJSONResponse({"success": False, "error": "code required"}, status_code=400)
+
+        if f"generate_{field_name}" not in code:
+            return ORJSONResponse({"success": False, "error": f"Function generate_{field_name} missing"}, status_code=400)
+
+        return ORJSONResponse({"success": True, "result": "Code structure valid. Execute in frontend."})
+
     except Exception as e:
-        return JSONResponse({"success": False, "error": f"PDF conversion failed: {str(e)}"}, status_code=500)
+        return ORJSONResponse({"success": False, "error": str(e)}, status_code=500)
 
 # route list
 routes = [
     Route("/", root),
+    Route("/health", health),
     Route("/upload", upload_files, methods=["POST"]),
     Route("/tags", get_tags, methods=["GET"]),
     Route("/rules/generate", generate_rule, methods=["POST"]),
     Route("/rules/test", test_rule, methods=["POST"]),
     Route("/document/render", render_document, methods=["POST"]),
     Route("/document/pdf", document_to_pdf, methods=["POST"]),
+    Route("/api/rules/generate", api_generate_rule, methods=["POST"]),
+    Route("/api/rules/test", api_test_rule, methods=["POST"]),
 ]
 
 middleware = [
     Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 ]
 
-app = Starlette(routes=routes, middleware=middleware)
+app = Starlette(routes=routes, middleware=middleware, on_shutdown=[rule_worker.close])
+
+if __name__ == "__main__":
+    import uvicorn
+    # RELOAD=1 for local development only; reload and multiple workers can't be combined
+    reload = os.getenv("RELOAD", "").lower() in ("1", "true", "yes")
+    uvicorn.run(
+        f"{Path(__file__).stem}:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=reload,
+        workers=1 if reload else max(2, (os.cpu_count() or 2) // 2),
+        loop="uvloop",
+        http="httptools",
+    )
@@ -0,0 +1,101 @@
+// Long-lived rule runner used by backend_main.NodeWorker.
+// Reads one JSON request per line on stdin: {"id": n, "rules": {tag: path}, "data": {...}, "timeout_ms": n}
+// and writes one JSON response per line on stdout: {"id": n, "results": {tag: value}, "errors": {tag: message}}
+const fs = require('fs');
+const readline = require('readline');
+const vm = require('vm');
+
+// rules may log freely; stdout is reserved for the protocol
+console.log = console.info = (...args) => console.error(...args);
+
+// loaded rule functions, reloaded when the file's mtime changes (e.g. after /rules/generate)
+const loaded = new Map();
+
+function loadRule(file) {
+  const mtime = fs.statSync(file).mtimeMs;
+  const cached = loaded.get(file);
+  if (cached && cached.mtime === mtime) return cached.fn;
+  delete require.cache[require.resolve(file)];
+  const fn = require(file);
+  loaded.set(file, { mtime, fn });
+  return fn;
+}
+
+// Calling the rule through a vm script lets node interrupt a runaway synchronous rule
+// (e.g. an infinite loop) after timeoutMs, without taking the whole worker down.
+// One context is created up front and reused; building a fresh one per call costs more than
+// most rules do. The call is synchronous, so concurrent requests can't interleave on it.
+const callRule = new vm.Script('__fn(__data)');
+const callContext = vm.createContext({});
+
+function runRule(fn, data, timeoutMs) {
+  callContext.__fn = fn;
+  callContext.__data = data;
+  let out;
+  try {
+    out = callRule.runInContext(callContext, { timeout: timeoutMs });
+  } finally {
+    callContext.__fn = callContext.__data = undefined;
+  }
+  if (!out || typeof out.then !== 'function') return out;
+  // async rules: bound how long we wait for the promise to settle
+  let timer;
+  const expired = new Promise((_, reject) => {
+    timer = setTimeout(() => reject(new Error('rule timed out after ' + timeoutMs + 'ms')), timeoutMs);
+  });
+  return Promise.race([out, expired]).finally(() => clearTimeout(timer));
+}
+
+function deepFreeze(value) {
+  if (value && typeof value === 'object' && !Object.isFrozen(value)) {
+    Object.freeze(value);
+    for (const key of Object.keys(value)) deepFreeze(value[key]);
+  }
+  return value;
+}
+
+function formatResult(out) {
+  // same formatting as the stdin runner in each rule file
+  if (typeof out === 'object') return JSON.stringify(out);
+  return String(out === undefined || out === null ? '' : out);
+}
+
+async function handle(line) {
+  let req;
+  try {
+    req = JSON.parse(line);
+  } catch (e) {
+    console.error('rule_server: bad request line:', e.message);
+    return;
+  }
+  const results = {};
+  const errors = {};
+  const timeoutMs = req.timeout_ms || 10000;
+  // parsed once per request and shared read-only by every rule, instead of one deep copy per rule
+  const data = deepFreeze(req.data || {});
+  for (const [tag, file] of Object.entries(req.rules || {})) {
+    try {
+      const fn = loadRule(file);
+      if (typeof fn !== 'function') throw new Error('No function found in rule file for tag ' + tag);
+      const out = await runRule(fn, data, timeoutMs);
+      results[tag] = formatResult(out);
+    } catch (e) {
+      errors[tag] = e && e.message ? e.message : String(e);
+    }
+  }
+  process.stdout.write(JSON.stringify({ id: req.id, results, errors }) + '\n');
+}
+
+const rl = readline.createInterface({ input: process.stdin, crlfDelay: Infinity });
+// requests still being handled; on stdin close their replies are written before exiting
+const inflight = new Set();
+rl.on('line', line => {
+  if (!line.trim()) return;
+  const pending = handle(line);
+  inflight.add(pending);
+  pending.finally(() => inflight.delete(pending));
+});
+rl.on('close', async () => {
+  await Promise.allSettled([...inflight]);
+  process.exit(0);
+});